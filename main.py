@@ -1,13 +1,23 @@
+import hashlib
+import json
 import os
+import random
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from functools import lru_cache
+from itertools import zip_longest
 from typing import Optional, List
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urljoin, urlsplit
 
 import gspread
-from google.oauth2.service_account import Credentials
 import requests
-from bs4 import BeautifulSoup
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from selectolax.lexbor import LexborHTMLParser
 
 
 SPREADSHEET_URL = os.getenv("SPREADSHEET_URL")
@@ -22,13 +32,130 @@ GIVEN_COL = os.getenv("GIVEN_COL", "J")
 
 OUTPUT_COL = os.getenv("OUTPUT_COL", "Q")
 
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+HOST_CONCURRENCY = int(os.getenv("HOST_CONCURRENCY", "4"))
+SLEEP_SEC = float(os.getenv("SLEEP_SEC", "0.5"))
+RATE_BURST = int(os.getenv("RATE_BURST", "3"))
+HTTP_CACHE = os.getenv("HTTP_CACHE", "ijf_cache")
+HTTP_CACHE_TTL = int(os.getenv("HTTP_CACHE_TTL", "86400"))
+HTTP_CACHE_KEEP_DAYS = float(os.getenv("HTTP_CACHE_KEEP_DAYS", "7"))
+NEGATIVE_CACHE = os.getenv("NEGATIVE_CACHE", "negative_cache.json")
+NEGATIVE_CACHE_DAYS = float(os.getenv("NEGATIVE_CACHE_DAYS", "7"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "50"))
+SHEETS_RETRIES = int(os.getenv("SHEETS_RETRIES", "5"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+IJF_BASE = "https://www.ijf.org"
+IJF_HOST = urlsplit(IJF_BASE).netloc
+
+SESSION = CachedSession(
+    HTTP_CACHE,
+    backend="sqlite",
+    expire_after=HTTP_CACHE_TTL,
+    allowable_methods=["GET"],
+    stale_if_error=True,
+)
+
+HOST_TAT = {}
+HOST_TAT_LOCK = threading.Lock()
+
+
+def throttle(host):
+
+    # token bucket per host: RATE_BURST sends at once, then one every
+    # SLEEP_SEC; waits only for the time actually owed
+
+    with HOST_TAT_LOCK:
+
+        now = time.monotonic()
+
+        tat = max(HOST_TAT.get(host, now), now)
+
+        HOST_TAT[host] = tat + SLEEP_SEC
+
+    delay = tat - (RATE_BURST - 1) * SLEEP_SEC - now
+
+    if delay > 0:
+
+        time.sleep(delay)
+
+
+class ThrottledAdapter(HTTPAdapter):
+
+    # cache hits are answered by CachedSession and never reach the adapter,
+    # so only real network sends are rate limited
+
+    def send(self, request, **kwargs):
 
-SESSION = requests.Session()
+        throttle(urlsplit(request.url).netloc)
+
+        return super().send(request, **kwargs)
+
+
+# no urllib3 retries here: they would run inside send() and bypass the
+# throttle, so http_get() retries instead
+
+ADAPTER = ThrottledAdapter(pool_connections=32, pool_maxsize=32)
+
+SESSION.mount("https://", ADAPTER)
+SESSION.mount("http://", ADAPTER)
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0",
+    "Accept-Encoding": "gzip, deflate",
 }
 
+_RE_WS = re.compile(r"\s+")
+_PUNCT = str.maketrans({",": " ", "\uff0c": " "})
+_RE_JUDOKA = re.compile(r"/judoka/\d+(?=/|$)")
+_RE_JUDOKA_HREF = re.compile(rb'<a\s[^>]*?(?<![\w-])href="(/judoka/\d+)[/"?]')
+
+HOST_SEMAPHORES = {}
+HOST_SEMAPHORES_LOCK = threading.Lock()
+
+
+def backoff_delay(retry_after, attempt):
+
+    # Retry-After when the server sends seconds (capped at RETRY_MAX_DELAY),
+    # otherwise exponential backoff with full jitter
+
+    if retry_after.isdigit():
+
+        return min(float(retry_after), RETRY_MAX_DELAY)
+
+    return random.uniform(0, 2 ** attempt)
+
+
+def sheets_call(fn, *args, **kwargs):
+
+    # retry rate limits and transient server errors
+
+    attempts = max(1, SHEETS_RETRIES)
+
+    for attempt in range(attempts):
+
+        try:
+
+            return fn(*args, **kwargs)
+
+        except gspread.exceptions.APIError as e:
+
+            status = e.response.status_code
+
+            if status not in RETRY_STATUSES or attempt == attempts - 1:
+
+                raise
+
+            delay = backoff_delay(e.response.headers.get("Retry-After", ""), attempt)
+
+            print("sheets retry", status, round(delay, 1))
+
+            time.sleep(delay)
+
 
 def open_sheet():
 
@@ -42,56 +169,223 @@ def open_sheet():
 
     gc = gspread.authorize(creds)
 
-    ss = gc.open_by_url(SPREADSHEET_URL)
+    ss = sheets_call(gc.open_by_url, SPREADSHEET_URL)
+
+    return sheets_call(ss.worksheet, SHEET_NAME)
+
+
+def host_semaphore(url):
+
+    host = urlsplit(url).netloc
+
+    with HOST_SEMAPHORES_LOCK:
+
+        sem = HOST_SEMAPHORES.get(host)
+
+        if sem is None:
+
+            sem = threading.BoundedSemaphore(HOST_CONCURRENCY)
+
+            HOST_SEMAPHORES[host] = sem
+
+    return sem
+
+
+def http_get(url):
+
+    # at most HOST_CONCURRENCY requests in flight per host; every attempt,
+    # retries included, goes through the adapter's throttle
+
+    retries = max(0, HTTP_RETRIES)
+
+    with host_semaphore(url):
+
+        for attempt in range(retries + 1):
+
+            last = attempt == retries
+
+            try:
+
+                r = SESSION.get(url, headers=HEADERS, timeout=30)
+
+            except (requests.ConnectionError, requests.Timeout) as e:
+
+                if last:
+
+                    raise
+
+                delay = max(SLEEP_SEC, backoff_delay("", attempt))
+
+                print("http retry", e.__class__.__name__, round(delay, 1))
+
+            else:
+
+                if r.status_code not in RETRY_STATUSES or last:
+
+                    return r
+
+                delay = max(SLEEP_SEC, backoff_delay(r.headers.get("Retry-After", ""), attempt))
+
+                print("http retry", r.status_code, round(delay, 1))
+
+            time.sleep(delay)
+
+
+def query_key(query):
+
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+
+def load_negative_cache():
 
-    return ss.worksheet(SHEET_NAME)
+    # query key -> time of the last search that found nothing; stale entries
+    # are dropped so those names get searched again
 
+    try:
 
+        with open(NEGATIVE_CACHE, encoding="utf-8") as f:
+
+            cache = json.load(f)
+
+    except (OSError, ValueError):
+
+        return {}
+
+    cutoff = time.time() - NEGATIVE_CACHE_DAYS * 86400
+
+    return {k: ts for k, ts in cache.items() if ts >= cutoff}
+
+
+def save_negative_cache(cache):
+
+    # write beside the target and swap it in, so a killed job never leaves a
+    # truncated file behind for actions/cache to upload
+
+    tmp = NEGATIVE_CACHE + ".tmp"
+
+    with open(tmp, "w", encoding="utf-8") as f:
+
+        json.dump(cache, f)
+
+    os.replace(tmp, NEGATIVE_CACHE)
+
+
+@lru_cache(maxsize=4096)
 def normalize(s):
 
-    s = (s or "").strip()
+    s = (s or "").translate(_PUNCT)
+
+    s = _RE_WS.sub(" ", s)
+
+    return s.strip()
 
-    s = s.replace(",", " ")
 
-    s = re.sub(r"\s+", " ", s)
+def build_query(full, fam, giv):
 
-    return s
+    fullname = normalize(full)
 
+    if fullname:
 
-def collect_links(html):
+        return fullname
 
-    soup = BeautifulSoup(html, "html.parser")
+    family = normalize(fam)
 
-    urls = []
+    given = normalize(giv)
 
-    for a in soup.find_all("a", href=True):
+    return f"{given} {family}".strip()
 
-        href = a["href"]
 
-        if re.search(r"/judoka/\d+", href):
+def first_judoka_link(html):
 
-            urls.append("https://www.ijf.org" + href)
+    tree = LexborHTMLParser(html)
 
-    return list(dict.fromkeys(urls))
+    for a in tree.css("a[href*='/judoka/']"):
+
+        # only ijf.org judoka pages count, not share links or other sites
+        # that merely mention one; return the same id-only shape as the
+        # byte regex in search_ijf()
+
+        parts = urlsplit(urljoin(IJF_BASE, a.attributes.get("href") or ""))
+
+        if parts.netloc != IJF_HOST:
+
+            continue
+
+        m = _RE_JUDOKA.match(parts.path)
+
+        if m:
+
+            return IJF_BASE + m.group(0)
+
+    return None
 
 
 def search_ijf(query):
 
-    url = "https://www.ijf.org/judoka?" + urlencode({"q": query})
+    url = IJF_BASE + "/judoka?" + urlencode({"q": query})
+
+    r = http_get(url)
+
+    r.raise_for_status()
+
+    # cheap scan of the raw bytes first; only parse the HTML when it misses
+
+    m = _RE_JUDOKA_HREF.search(r.content)
+
+    if m:
+
+        return IJF_BASE + m.group(1).decode()
+
+    return first_judoka_link(r.content)
+
+
+def update_cells_in_col(ws, col, updates):
+
+    # one range per run of consecutive rows instead of one per cell
+
+    runs = []
+
+    for row, value in sorted(updates):
+
+        if runs and runs[-1][1] == row - 1:
+
+            runs[-1][1] = row
+
+            runs[-1][2].append([value])
+
+        else:
+
+            runs.append([row, row, [[value]]])
+
+    data = [
+        {"range": f"{col}{start}:{col}{end}", "values": values}
+        for start, end, values in runs
+    ]
+
+    sheets_call(ws.batch_update, data, value_input_option="RAW")
+
+
+def flush_updates(ws, updates, failed):
 
-    r = SESSION.get(url, headers=HEADERS)
+    # a flush that still fails after sheets_call() retries is set aside for
+    # a final attempt, so the searches already in flight are not wasted
 
-    if r.status_code != 200:
+    try:
 
-        return None
+        update_cells_in_col(ws, OUTPUT_COL, updates)
 
-    links = collect_links(r.text)
+    except gspread.exceptions.APIError as e:
 
-    if not links:
+        print("flush failed", len(updates), e)
 
-        return None
+        failed.extend(updates)
 
-    return links[0]
+
+def lookup(query):
+
+    print("search", query)
+
+    return search_ijf(query)
 
 
 def main():
@@ -100,45 +394,122 @@ def main():
 
     ws = open_sheet()
 
-    full_vals = ws.get(f"{FULLNAME_COL}{START_ROW}:{FULLNAME_COL}{END_ROW}")
+    negative_cache = load_negative_cache()
 
-    fam_vals = ws.get(f"{FAMILY_COL}{START_ROW}:{FAMILY_COL}{END_ROW}")
+    ranges = sheets_call(
+        ws.batch_get,
+        [
+            f"{FULLNAME_COL}{START_ROW}:{FULLNAME_COL}{END_ROW}",
+            f"{FAMILY_COL}{START_ROW}:{FAMILY_COL}{END_ROW}",
+            f"{GIVEN_COL}{START_ROW}:{GIVEN_COL}{END_ROW}",
+            f"{OUTPUT_COL}{START_ROW}:{OUTPUT_COL}{END_ROW}",
+        ],
+        major_dimension="COLUMNS",
+    )
 
-    giv_vals = ws.get(f"{GIVEN_COL}{START_ROW}:{GIVEN_COL}{END_ROW}")
+    # each range comes back as one flat column, or [] when it is empty
 
-    out_vals = ws.get(f"{OUTPUT_COL}{START_ROW}:{OUTPUT_COL}{END_ROW}")
+    full_vals, fam_vals, giv_vals, out_vals = (vr[0] if vr else [] for vr in ranges)
 
-    for i in range(len(full_vals)):
+    # the API drops trailing empty cells; the row range is always the
+    # longest sequence, so zip_longest pads the columns back out
 
-        row = START_ROW + i
+    rows = zip_longest(
+        range(START_ROW, END_ROW + 1),
+        full_vals,
+        fam_vals,
+        giv_vals,
+        out_vals,
+        fillvalue="",
+    )
 
-        if out_vals[i] and out_vals[i][0]:
+    queries = [
+        (row, build_query(full, fam, giv))
+        for row, full, fam, giv, out in rows
+        if not out
+    ]
 
-            continue
+    # rows sharing a name are searched once and the result fanned out
 
-        fullname = normalize(full_vals[i][0]) if full_vals[i] else ""
+    targets = {}
 
-        family = normalize(fam_vals[i][0]) if fam_vals[i] else ""
+    for row, query in queries:
 
-        given = normalize(giv_vals[i][0]) if giv_vals[i] else ""
+        if query and query_key(query) not in negative_cache:
 
-        query = fullname if fullname else f"{given} {family}"
+            targets.setdefault(query, []).append(row)
 
-        print("search", query)
+    updates = []
 
-        url = search_ijf(query)
+    failed = []
 
-        if url:
+    try:
 
-            ws.update_acell(f"{OUTPUT_COL}{row}", url)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
 
-            print("found", url)
+            futures = {executor.submit(lookup, query): query for query in targets}
 
-        else:
+            try:
+
+                for future in as_completed(futures):
+
+                    query = futures[future]
+
+                    target_rows = targets[query]
+
+                    try:
+
+                        url = future.result()
+
+                    except requests.RequestException as e:
+
+                        print("error", query, e)
+
+                        continue
+
+                    if url:
+
+                        updates.extend((row, url) for row in target_rows)
+
+                        print("found", query, url, target_rows)
+
+                    else:
+
+                        negative_cache[query_key(query)] = time.time()
+
+                        print("not found", query, target_rows)
+
+                    if len(updates) >= BATCH_SIZE:
+
+                        flush_updates(ws, updates, failed)
+
+                        updates = []
+
+            except BaseException:
+
+                # drop the queued searches instead of running them for
+                # results that will never be written
+
+                executor.shutdown(cancel_futures=True)
+
+                raise
+
+        # one last attempt for batches whose flush failed earlier
+
+        updates = failed + updates
+
+        if updates:
+
+            update_cells_in_col(ws, OUTPUT_COL, updates)
+
+    finally:
+
+        save_negative_cache(negative_cache)
 
-            print("not found")
+    # keep recently expired pages around for stale_if_error, but stop the
+    # cache file shipped between runs from growing without bound
 
-        time.sleep(0.5)
+    SESSION.cache.delete(older_than=timedelta(days=HTTP_CACHE_KEEP_DAYS))
 
 
 if __name__ == "__main__":